@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
-import argparse, subprocess, os, tempfile, shutil
+import argparse, subprocess, os, tempfile, shutil, sys
 from typing import Tuple
+import numpy as np
 
 
 def explode(filename: str) -> Tuple[str, str, str]:
@@ -9,6 +10,99 @@ def explode(filename: str) -> Tuple[str, str, str]:
     directory, name = os.path.split(base)
     return (directory, name, ext)
 
+def jacobian_determinant(displacement: str, like: str, output: str,
+                         log: bool = False, nslices: int = 10) -> None:
+    """Computes the determinant of the Jacobian (I + grad u) of a displacement
+    field u (as written by minc_displacement) and writes it, or its log, to
+    output (sampled like like). The field is read a slab of nslices slices at
+    a time, with one more slice on either side; the gradient is taken by
+    central differences in the interior (one-sided at the borders) along the
+    voxel axes, and turned into world derivatives using the voxel
+    separations and direction cosines."""
+    from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
+
+    field = volumeFromFile(displacement, dtype='double')
+    names = list(field.dimnames)
+    vector_axis = names.index("vector_dimension")
+    spatial = [i for i in range(field.ndims) if i != vector_axis]
+    # the world vector of a step along each voxel axis (as columns)
+    steps = np.empty((3, 3))
+    for column, i in enumerate(spatial):
+        steps[:, column] = field.separations[i] * np.array(field.get_direction_cosines(names[i])[0:3])
+    # d u / d world = (d u / d voxel) inverse(steps)
+    to_world = np.linalg.inv(steps)
+    # finite differences need two samples along every axis
+    for i in spatial:
+        if field.sizes[i] < 2:
+            field.closeVolume()
+            raise ValueError("%s has a single sample along %s, the Jacobian needs at least two"
+                             % (displacement, names[i]))
+    # the output is written in the field's voxel order, so like has to share it
+    likevol = volumeFromFile(like, dtype='double')
+    like_shape = (list(likevol.dimnames), list(likevol.sizes[0:likevol.ndims]))
+    likevol.closeVolume()
+    field_shape = ([names[i] for i in spatial], [field.sizes[i] for i in spatial])
+    if like_shape != field_shape:
+        field.closeVolume()
+        raise ValueError("%s is %s (%s), the displacement field %s (%s)"
+                         % (like, "x".join(map(str, like_shape[1])), ",".join(like_shape[0]),
+                            "x".join(map(str, field_shape[1])), ",".join(field_shape[0])))
+
+    # the output is written slab by slab
+    outvol = volumeLikeFile(like, output, dtype='double', volumeType='double')
+    if not outvol.dataLoadable:
+        outvol.createVolumeImage()
+    outmin, outmax = np.inf, -np.inf
+    # the slabs are taken along the first spatial dimension
+    slab_axis = spatial[0]
+    size = field.sizes[slab_axis]
+    for i in range(0, size, nslices):
+        n = nslices if i + nslices <= size else size - i
+        # one slice on either side, so that the slab gets central differences
+        # (a last slab of a single slice still has its neighbour before it)
+        lo = i - 1 if i > 0 else 0
+        hi = i + n + 1 if i + n < size else size
+        start = [0] * field.ndims
+        count = list(field.sizes[0:field.ndims])
+        start[slab_axis], count[slab_axis] = lo, hi - lo
+        u = field.getHyperslab(tuple(start), tuple(count))
+        u.shape = tuple(count)
+        # the (x, y, z) displacements, each over the voxel axes
+        u = np.moveaxis(u, vector_axis, 0)
+        jacobian = [[None] * 3 for k in range(3)]
+        for k in range(3):
+            gradient = [g[i-lo:i-lo+n] for g in np.gradient(u[k])]
+            for w in range(3):
+                jacobian[k][w] = gradient[0] * to_world[0, w] + gradient[1] * to_world[1, w] + \
+                                 gradient[2] * to_world[2, w]
+                if k == w:
+                    jacobian[k][w] += 1
+        (a, b, c), (d, e, f), (g, h, j) = jacobian
+        determinant = a * (e*j - f*h) - b * (d*j - f*g) + c * (d*h - e*g)
+        if log:
+            np.log(determinant, out=determinant)
+        outvol.setHyperslab(determinant, (i,0,0), determinant.shape)
+        outmin = min(outmin, np.nanmin(determinant))
+        outmax = max(outmax, np.nanmax(determinant))
+
+    outvol.setVolumeRanges(np.array([outmin, outmax]))
+    outvol.closeVolume()
+    field.closeVolume()
+
+def compare_determinants(filename1: str, filename2: str) -> Tuple[float, float]:
+    """The largest and mean absolute difference between two determinant files,
+    leaving out the voxels on the border of the volume (where finite
+    differences are one-sided and may be computed differently)."""
+    from pyminc.volumes.factory import volumeFromFile
+
+    vol1 = volumeFromFile(filename1, dtype='double')
+    vol2 = volumeFromFile(filename2, dtype='double')
+    interior = (slice(1, -1),) * vol1.data.ndim
+    difference = np.abs(vol1.data[interior] - vol2.data[interior])
+    vol1.closeVolume()
+    vol2.closeVolume()
+    return difference.max(), difference.mean()
+
 if __name__ == "__main__":
 
     description = 'Compute the determinant of a transform.'
@@ -46,6 +140,28 @@ if __name__ == "__main__":
                         dest='log',
                         help='compute the logarithm of the transformation'
                         )
+    parser.add_argument('--engine',
+                        dest='engine',
+                        choices=['mincblob', 'python'],
+                        default='mincblob',
+                        help="how to compute the determinant of the displacement field: with "
+                        "mincblob and mincmath, or in this process (reading the field once and "
+                        "writing only the output) [default: %(default)s]"
+                        )
+    parser.add_argument('--compare-mincblob',
+                        action='store_true',
+                        default=False,
+                        dest='compare_mincblob',
+                        help='with --engine python (required), also compute the determinant with '
+                        'mincblob and report the differences (exits with status 1 if they exceed '
+                        '--tolerance)'
+                        )
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=1e-3,
+                        dest='tolerance',
+                        help='largest difference allowed by --compare-mincblob [default: %(default)s]'
+                        )
     parser.add_argument("--temp-dir",
                         dest="temp_dir",
                         default="/tmp",
@@ -80,6 +196,12 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    if args.compare_mincblob and args.engine != 'python':
+        parser.error("--compare-mincblob compares --engine python with mincblob")
+    # mincblob/mincmath refuse to overwrite without -clobber; so does the python engine
+    if args.engine == 'python' and not args.clobber and os.path.exists(args.output_determinant):
+        parser.error("%s exists, use --clobber to overwrite it" % args.output_determinant)
+
     def run_subprocess(cmds):
         cmdstr = " ".join(cmds)
         if args.verbose:
@@ -164,29 +286,46 @@ if __name__ == "__main__":
                             displacement,
                             smooth_displacement])
 
-    temp_determinant = os.path.join(tempdir, output_name + "_temp_determinant.mnc")
-    p = run_subprocess(["mincblob",
-                        "-determinant",
-                        "-clobber" if args.clobber else "",
-                        smooth_displacement if args.smooth else displacement,
-                        temp_determinant])
-    if not args.log:
-        p = run_subprocess(["mincmath -2 -const 1 -add", #mincblob output needs this
-                                 "-clobber" if args.clobber else "",
-                            temp_determinant,
-                            args.output_determinant
-                            ])
-    else:
-        nolog_determinant = os.path.join(tempdir, output_name + "_nolog_determinant.mnc")
-        p = run_subprocess(["mincmath -2 -const 1 -add",  # mincblob output needs this
-                            "-clobber" if args.clobber else "",
-                            temp_determinant,
-                            nolog_determinant
-                            ])
-        p = run_subprocess(["mincmath -2 -log",
+    field = smooth_displacement if args.smooth else displacement
+    if args.engine == 'python':
+        jacobian_determinant(field, args.input_like, args.output_determinant, log=args.log)
+    if args.engine == 'mincblob' or args.compare_mincblob:
+        if args.engine == 'mincblob':
+            output_determinant = args.output_determinant
+        else:
+            output_determinant = os.path.join(tempdir, output_name + "_mincblob_determinant.mnc")
+        temp_determinant = os.path.join(tempdir, output_name + "_temp_determinant.mnc")
+        p = run_subprocess(["mincblob",
+                            "-determinant",
                             "-clobber" if args.clobber else "",
-                            nolog_determinant,
-                            args.output_determinant
-                            ])
+                            field,
+                            temp_determinant])
+        if not args.log:
+            p = run_subprocess(["mincmath -2 -const 1 -add", #mincblob output needs this
+                                     "-clobber" if args.clobber else "",
+                                temp_determinant,
+                                output_determinant
+                                ])
+        else:
+            nolog_determinant = os.path.join(tempdir, output_name + "_nolog_determinant.mnc")
+            p = run_subprocess(["mincmath -2 -const 1 -add",  # mincblob output needs this
+                                "-clobber" if args.clobber else "",
+                                temp_determinant,
+                                nolog_determinant
+                                ])
+            p = run_subprocess(["mincmath -2 -log",
+                                "-clobber" if args.clobber else "",
+                                nolog_determinant,
+                                output_determinant
+                                ])
+
+    if args.compare_mincblob:
+        largest, mean = compare_determinants(args.output_determinant, output_determinant)
+        print("Difference with mincblob (interior voxels): largest %g, mean %g" % (largest, mean))
+        if largest > args.tolerance:
+            if not args.keep_temp:
+                shutil.rmtree(tempdir)
+            sys.exit(1)
+
     if not args.keep_temp:
         shutil.rmtree(tempdir)
\ No newline at end of file
@@ -3,6 +3,7 @@
 
 from pyminc.volumes.factory import *
 from numpy import *
+from scipy import ndimage
 from argparse import ArgumentParser
 import tempfile
 import os
@@ -12,12 +13,45 @@ import shutil
 import subprocess
 import sys
 import math
+import multiprocessing
+import hashlib
+import json
+import csv
+import time
+import resource
+import contextlib
 
+# set in worker processes of a --jobs pool: each worker keeps its temporary
+# files in its own subdirectory of the main process's rot_<pid> directory
+worker_tmpdir = None
+# set while a source of a --batch run is being aligned: the temporary files
+# of that source are kept in (and removed with) their own subdirectory
+source_tmpdir = None
+# the pool currently evaluating rotations (if any), so that termtrapper
+# can shut the workers down before removing their temporary files
+active_pool = None
+
+# with --profile-json: the timing records of this process (see profiled
+# and check_call), the stages currently running, outermost first, and the
+# temporary files whose size has not been recorded yet
+profile = None
+profile_stages = []
+profile_tempfiles = []
+
+
+def get_tmpdir():
+    if source_tmpdir is not None:
+        return source_tmpdir
+    if worker_tmpdir is not None:
+        return worker_tmpdir
+    return get_run_tmpdir()
+
+def get_run_tmpdir():
+    return "%s/rot_%s" % (os.environ["TMPDIR"], os.getpid())
 
 def get_tempfile(suffix):
     counter = 0
-    pid = os.getpid()
-    tmpdir = "%s/rot_%s" % (os.environ["TMPDIR"], pid)
+    tmpdir = get_tmpdir()
     if not os.access(tmpdir, 0):
         try:
             subprocess.check_call(("mkdir -p %s" % tmpdir).split())
@@ -28,10 +62,80 @@ def get_tempfile(suffix):
     while os.access(tmpfile, 0):
         counter = counter + 1
         tmpfile = "/%s/rot_%s%s" % (tmpdir, counter, suffix)
+    if profile is not None:
+        profile_tempfiles.append(tmpfile)
     return tmpfile
 
+def cpu_time():
+    # of this process and of the (finished) processes it started
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+@contextlib.contextmanager
+def profiled(stage):
+    # with --profile-json, record the wall and cpu time of a stage of the
+    # run (also usable as a decorator). Stages are named after the stages
+    # they run in, e.g. rotation/minctracc
+    if profile is None:
+        yield
+        return
+    profile_stages.append(stage)
+    wall, cpu = time.time(), cpu_time()
+    try:
+        yield
+    finally:
+        profile.append({'stage': "/".join(profile_stages),
+                        'wall': time.time() - wall, 'cpu': cpu_time() - cpu})
+        profile_stages.pop()
+
+def run_tool(run, cmd):
+    # with --profile-json, record the wall and cpu time of a minc tool, and
+    # the size of the temporary files it wrote
+    if profile is None:
+        return run(cmd)
+    wall, cpu = time.time(), cpu_time()
+    result = run(cmd)
+    tmp_bytes = 0
+    for f in list(profile_tempfiles):
+        if os.path.exists(f):
+            tmp_bytes += os.path.getsize(f)
+            profile_tempfiles.remove(f)
+    profile.append({'tool': os.path.basename(cmd[0]), 'stage': "/".join(profile_stages),
+                    'wall': time.time() - wall, 'cpu': cpu_time() - cpu,
+                    'tmp_bytes': tmp_bytes})
+    return result
+
+def check_call(cmd):
+    return run_tool(subprocess.check_call, cmd)
+
+def check_output(cmd):
+    return run_tool(subprocess.check_output, cmd)
+
+def profile_summary(wall, cpu):
+    # totals per stage and per tool; times of stages that ran in worker
+    # processes are summed over the workers
+    stages = {}
+    tools = {}
+    for record in profile:
+        if 'tool' in record:
+            totals = tools.setdefault(record['tool'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'tmp_bytes': 0})
+            totals['tmp_bytes'] += record['tmp_bytes']
+        else:
+            totals = stages.setdefault(record['stage'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'tmp_bytes': 0})
+        totals['calls'] += 1
+        totals['wall'] += record['wall']
+        totals['cpu'] += record['cpu']
+    # the temporary files of a stage are those written by the tools it ran
+    for record in profile:
+        if 'tool' in record:
+            for stage, totals in stages.items():
+                if record['stage'] == stage or record['stage'].startswith(stage + "/"):
+                    totals['tmp_bytes'] += record['tmp_bytes']
+    return {'total': {'wall': wall, 'cpu': cpu}, 'stages': stages, 'tools': tools, 'steps': profile}
+
+@profiled("cog")
 def get_centre_of_gravity(file):
-    lines = subprocess.check_output(["volume_cog", file])
+    lines = check_output(["volume_cog", file])
     line = lines.decode().split('\n')[-2]
     cog = array(line.strip().split(" ")).astype("float32")
     return cog
@@ -69,6 +173,7 @@ def get_coordinates_from_tag_file(tag_file):
     return all_coordinates
 
 
+@profiled("peaks")
 def get_distance_transform_peaks(input_file, peak_distance):
     #
     # for solid input files (brains, embryos) we can
@@ -78,54 +183,59 @@ def get_distance_transform_peaks(input_file, peak_distance):
     #
     # the .decode() in the end removes the b from the front
     # of the returned string (Python3 default)
-    bimodalt_value = subprocess.check_output(["mincstats",
+    bimodalt_value = check_output(["mincstats",
                                              "-quiet",
                                              "-biModalT",
                                              input_file]).rstrip().decode()
-    max_value = subprocess.check_output(["mincstats",
+    max_value = check_output(["mincstats",
                                          "-quiet",
                                          "-max",
                                          input_file]).rstrip().decode()
     distance_transform = get_tempfile('.mnc')
-    subprocess.check_call(("mincmorph -successive B[%s:%s]F %s %s" %
+    check_call(("mincmorph -successive B[%s:%s]F %s %s" %
                             (bimodalt_value,max_value,input_file,distance_transform)).split())
     peak_tags = get_tempfile('.tag')
-    subprocess.check_call(("find_peaks -pos_only -min_distance %s %s %s" % (peak_distance, distance_transform, peak_tags)).split())
+    check_call(("find_peaks -pos_only -min_distance %s %s %s" % (peak_distance, distance_transform, peak_tags)).split())
     all_coors = get_coordinates_from_tag_file(peak_tags)
     return all_coors
 
+@profiled("peaks")
 def get_blur_peaks(input_file, blur_kernel, peak_distance):
     blurred_input = get_tempfile('_blur.mnc')
-    subprocess.check_call(("mincblur -no_apo -fwhm %s %s %s" % (blur_kernel, input_file, blurred_input.split('_blur.mnc')[0])).split())
+    check_call(("mincblur -no_apo -fwhm %s %s %s" % (blur_kernel, input_file, blurred_input.split('_blur.mnc')[0])).split())
     peak_tags = get_tempfile('.tag')
-    subprocess.check_call(("find_peaks -pos_only -min_distance %s %s %s" % (peak_distance, blurred_input, peak_tags)).split())
+    check_call(("find_peaks -pos_only -min_distance %s %s %s" % (peak_distance, blurred_input, peak_tags)).split())
     all_coors = get_coordinates_from_tag_file(peak_tags)
     return all_coors
 
 
+@profiled("compute_xcorr")
 def compute_xcorr(sourcefile, targetfile, maskfile):
-    return float(subprocess.check_output(
+    return float(check_output(
                    ['minccmp', '-xcorr']
                  + (['-mask', maskfile] if maskfile is not None else [])
                  + [sourcefile, targetfile]).split()[1])
 
 
+@profiled("create_transform")
 def create_transform(cog_diff, xrot, yrot, zrot, cog_source):
     # create temporary file for transform
     tmp_transform = get_tempfile('.xfm')
-    subprocess.check_call(("param2xfm -translation %s %s %s -rotation %s %s %s -center %s %s %s %s"
+    check_call(("param2xfm -translation %s %s %s -rotation %s %s %s -center %s %s %s %s"
                            % (cog_diff[0], cog_diff[1], cog_diff[2],
                               xrot, yrot, zrot,
                               cog_source[0], cog_source[1], cog_source[2],
                               tmp_transform)).split())
     return tmp_transform
 
+@profiled("resample_volume")
 def resample_volume(source, target, transform):
     tmp_resampled = get_tempfile('.mnc')
-    subprocess.check_call(("mincresample -transform %s -like %s %s %s"
+    check_call(("mincresample -transform %s -like %s %s %s"
                           % (transform, target, source, tmp_resampled)).split())
     return tmp_resampled
 
+@profiled("minctracc")
 def minctracc(source, target, *, source_mask, target_mask, stepsize, wtranslations, simplex, use_lsq12_for_alignment):
     wtrans_decomp = array(wtranslations.split(',')).astype("float")
     tmp_transform = get_tempfile('.xfm')
@@ -137,15 +247,17 @@ def minctracc(source, target, *, source_mask, target_mask, stepsize, wtranslatio
            #wtrans_decomp[0], wtrans_decomp[1], wtrans_decomp[2]))
            f" {source} {target} {tmp_transform}")
     print(cmd)
-    subprocess.check_call(cmd.split())
+    check_call(cmd.split())
 
     return tmp_transform
 
+@profiled("concat_transforms")
 def concat_transforms(t1, t2):
     tmp_transform = get_tempfile('.xfm')
-    subprocess.check_call(("xfmconcat %s %s %s" % (t1, t2, tmp_transform)).split())
+    check_call(("xfmconcat %s %s %s" % (t1, t2, tmp_transform)).split())
     return tmp_transform
 
+@profiled("seed_scoring")
 def get_cross_correlation_from_coordinate_pair(source_img, target_img, mask_img, coordinate_pair):
     # Generate a transformation based on the coordinate_pair provided. Apply this
     # transformation to the source_img and calculate the cross correlation between
@@ -165,10 +277,383 @@ def get_cross_correlation_from_coordinate_pair(source_img, target_img, mask_img,
     os.remove(transform_from_coordinates)
     return float(xcorr)
 
+@profiled("load_image")
+def load_image(filename):
+    # read a (downsampled) volume into memory once, along with the affine
+    # that maps its voxel indices onto world coordinates
+    vol = volumeFromFile(filename, dtype='double')
+    data = array(vol.data)
+    origin = asarray(vol.convertVoxelToWorld([0, 0, 0]), dtype='float64')
+    affine = eye(4)
+    for axis in range(3):
+        voxel = [0, 0, 0]
+        voxel[axis] = 1
+        affine[:3, axis] = asarray(vol.convertVoxelToWorld(voxel), dtype='float64') - origin
+    affine[:3, 3] = origin
+    vol.closeVolume()
+    return {'data': data, 'affine': affine}
+
+def rotation_matrix(xrot, yrot, zrot):
+    # rotations in degrees, composed as in param2xfm (make_rots): the
+    # rotation around x is applied first, then y, then z (Rz Ry Rx)
+    ax, ay, az = radians(xrot), radians(yrot), radians(zrot)
+    rx = array([[1, 0, 0], [0, cos(ax), -sin(ax)], [0, sin(ax), cos(ax)]])
+    ry = array([[cos(ay), 0, sin(ay)], [0, 1, 0], [-sin(ay), 0, cos(ay)]])
+    rz = array([[cos(az), -sin(az), 0], [sin(az), cos(az), 0], [0, 0, 1]])
+    return rz.dot(ry).dot(rx)
+
+def rotation_angles(matrix):
+    # the inverse of rotation_matrix: the x, y and z rotations (in degrees)
+    # that param2xfm turns into this rotation matrix
+    xrot = arctan2(matrix[2, 1], matrix[2, 2])
+    yrot = arcsin(clip(-matrix[2, 0], -1, 1))
+    zrot = arctan2(matrix[1, 0], matrix[0, 0])
+    return tuple(round(float(degrees(angle)), 3) for angle in (xrot, yrot, zrot))
+
+def quaternion_to_matrix(q):
+    w, x, y, z = q
+    return array([[1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)],
+                  [2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)],
+                  [2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)]])
+
+def get_rotations(start, interval, sampling="euler", tolerance=None):
+    # The (x, y, z) rotations (in degrees) to start a registration from.
+    #
+    # euler:   every combination of -start to start in steps of interval,
+    #          around each of the three axes
+    # uniform: a near-uniform sampling of all rotations by at most start
+    #          degrees. The samples come from a super-Fibonacci spiral on the
+    #          unit quaternions (Alexa, CVPR 2022); samples within tolerance
+    #          degrees of one already chosen are left out. The density is
+    #          chosen so that, on average, a rotation is no further from
+    #          its nearest sample than it is on the Euler grid, which takes
+    #          40-60% fewer samples
+    if sampling == "euler":
+        return [(x, y, z)
+                for x in range(-start, start+1, interval)
+                for y in range(-start, start+1, interval)
+                for z in range(-start, start+1, interval)]
+    spacing = radians(interval)
+    if tolerance is None:
+        tolerance = interval / 2
+    # a cube of side spacing in the rotation vector space covers
+    # spacing^3 / (8 pi^2) of all rotations; 1.5 times that density
+    # matches the coverage of the Euler grid
+    n = int(ceil(1.5 * 8 * pi ** 2 / spacing ** 3))
+    s = arange(n) + 0.5
+    r = sqrt(s / n)
+    R = sqrt(1 - s / n)
+    alpha = 2 * pi * s / sqrt(2)
+    beta = 2 * pi * s / 1.533751168755204288118041
+    quaternions = column_stack([R * cos(beta), r * sin(alpha), r * cos(alpha), R * sin(beta)])
+    angles = 2 * arccos(clip(abs(quaternions[:, 0]), 0, 1))
+    quaternions = vstack([[1, 0, 0, 0], quaternions[angles <= radians(start)]])
+    # q and -q are the same rotation, 2 arccos(|q1.q2|) is the angle between two rotations
+    kept = []
+    for q in quaternions:
+        if not kept or abs(array(kept).dot(q)).max() < cos(radians(tolerance) / 2):
+            kept.append(q)
+    return [rotation_angles(quaternion_to_matrix(q)) for q in kept]
+
+def transform_matrix(cog_diff, xrot, yrot, zrot, cog_source):
+    # the world-to-world matrix of the transform create_transform writes:
+    # rotate around cog_source, then translate by cog_diff
+    rotation = rotation_matrix(xrot, yrot, zrot)
+    matrix = eye(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = asarray(cog_source) - rotation.dot(cog_source) + asarray(cog_diff)
+    return matrix
+
+def resample_in_memory(source, target, matrix, order=1):
+    # the in-memory equivalent of resample_volume: sample the source image on
+    # the grid of the target image, after transforming it with matrix
+    # (trilinear interpolation by default, zero outside the source)
+    voxel_matrix = linalg.inv(source['affine']).dot(linalg.inv(matrix)).dot(target['affine'])
+    return ndimage.affine_transform(source['data'], voxel_matrix[:3, :3],
+                                    offset=voxel_matrix[:3, 3],
+                                    output_shape=target['data'].shape,
+                                    order=order, cval=0.0)
+
+def masked_xcorr(sourcedata, targetdata, maskdata=None):
+    # same normalised cross correlation as minccmp -xcorr
+    if maskdata is not None:
+        sourcedata = sourcedata[maskdata]
+        targetdata = targetdata[maskdata]
+    denominator = sqrt(vdot(sourcedata, sourcedata) * vdot(targetdata, targetdata))
+    if denominator == 0:
+        return 0.0
+    return float(vdot(sourcedata, targetdata) / denominator)
+
+def load_target_mask(mask_img, target):
+    # the mask as a boolean array on the grid of the target image. After
+    # autocrop the mask need not share the target's sampling
+    if mask_img is None:
+        return None
+    mask = load_image(mask_img)
+    if mask['data'].shape != target['data'].shape or not allclose(mask['affine'], target['affine']):
+        mask['data'] = resample_in_memory(mask, target, eye(4), order=0)
+    return mask['data'] > 0.5
+
+@profiled("seed_scoring")
+def get_cross_correlations_from_coordinate_pairs(source_img, target_img, mask_img, coordinate_pairs):
+    # The in-memory version of get_cross_correlation_from_coordinate_pair for
+    # a whole batch of seed pairs: the volumes are read only once, and the
+    # translated sources are never written to disk
+    source = load_image(source_img)
+    target = load_image(target_img)
+    maskdata = load_target_mask(mask_img, target)
+    xcorrs = []
+    for coordinate_pair in coordinate_pairs:
+        matrix = transform_matrix(coordinate_pair[1] - coordinate_pair[0], 0, 0, 0, coordinate_pair[0])
+        xcorrs.append(masked_xcorr(resample_in_memory(source, target, matrix),
+                                   target['data'], maskdata))
+    return xcorrs
+
+@profiled("prescreen")
+def prescreen_candidates(candidates, *, source, target, target_mask, top_k=None, margin=None):
+    # Score every (seed pair, rotation) candidate by rigidly resampling the
+    # source in memory and computing the cross correlation with the target,
+    # and keep only the top_k best candidates and/or those within margin of
+    # the best score for the (expensive) minctracc registrations. The
+    # candidates that are kept stay in their original order
+    source_image = load_image(source)
+    target_image = load_image(target)
+    maskdata = load_target_mask(target_mask, target_image)
+    scores = []
+    for coor_src, coor_trgt, x, y, z in candidates:
+        matrix = transform_matrix(coor_trgt - coor_src, x, y, z, coor_src)
+        scores.append(masked_xcorr(resample_in_memory(source_image, target_image, matrix),
+                                   target_image['data'], maskdata))
+    scores = array(scores)
+    keep = zeros(len(candidates), dtype=bool)
+    if top_k is not None:
+        keep[argsort(-scores, kind='stable')[:top_k]] = True
+    if margin is not None:
+        keep |= scores >= scores.max() - margin
+    print("\n\nPrescreen: keeping %d of %d candidates, skipping %d minctracc calls "
+          "(best prescreen xcorr: %s)\n" % (keep.sum(), len(candidates),
+                                              len(candidates) - keep.sum(), scores.max()))
+    return [candidate for candidate, k in zip(candidates, keep) if k]
+
+@profiled("rotation")
+def evaluate_rotation(candidate, *, stepsize, source, target, source_mask, target_mask,
+                      simplex, wtranslations, use_lsq12_for_alignment):
+    # register the source to the target starting from a single seed pair and
+    # rotation; returns the cross correlation after the registration
+    coor_src, coor_trgt, x, y, z = candidate
+    # we need to include the centre of the volume as rotation centre = cog1
+    init_transform = create_transform(coor_trgt - coor_src, x, y, z, coor_src)
+    init_resampled = resample_volume(source, target, init_transform)
+    transform = minctracc(init_resampled, target,
+                          source_mask=source_mask, target_mask=target_mask,
+                          stepsize=stepsize,
+                          wtranslations=wtranslations, simplex=simplex,
+                          use_lsq12_for_alignment=use_lsq12_for_alignment)
+    resampled = resample_volume(init_resampled, target, transform)
+    conc_transform = concat_transforms(init_transform, transform)
+    xcorr = compute_xcorr(resampled, target, maskfile=target_mask)
+    if isnan(xcorr):
+        xcorr = 0
+    with open(conc_transform) as f:
+        xfm = f.read()
+    # had some issues with the resampled file being gone...
+    # we'll just resample the final file only at the end
+    os.remove(resampled)
+    os.remove(init_resampled)
+    os.remove(conc_transform)
+    os.remove(init_transform)
+    os.remove(transform)
+    print("FINISHED: %s %s %s :: %s" % (x,y,z, xcorr))
+    return {'xcorr': xcorr, 'xfm': xfm,
+            'xrot': x, 'yrot': y, 'zrot': z,
+            'coor_src' : coor_src, 'coor_trgt' : coor_trgt }
+
+def get_run_key(files, settings):
+    # identifies the inputs of a run in its checkpoint: a hash of the contents
+    # of the input files and masks, and of the options that change the outcome
+    # of a registration (but not of --range/--interval, so that a run with a
+    # different rotation grid can reuse the grid points it shares)
+    run_hash = hashlib.sha1()
+    for filename in files:
+        if filename is None:
+            run_hash.update(b"None")
+            continue
+        with open(filename, 'rb') as f:
+            for block in iter(functools.partial(f.read, 1 << 20), b''):
+                run_hash.update(block)
+    run_hash.update(json.dumps(settings, sort_keys=True).encode())
+    return run_hash.hexdigest()
+
+def candidate_key(coor_src, coor_trgt, x, y, z):
+    return "%s|%s|%s %s %s" % (" ".join("%.3f" % c for c in coor_src),
+                               " ".join("%.3f" % c for c in coor_trgt),
+                               x, y, z)
+
+def read_checkpoint(checkpoint, run_key):
+    # the results of all grid points evaluated earlier for the same inputs
+    completed = {}
+    if not os.path.exists(checkpoint):
+        return completed
+    with open(checkpoint) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a line that was cut off when the previous run was killed
+                continue
+            if record['run'] != run_key:
+                continue
+            result = {'xcorr': record['xcorr'], 'xfm': record['xfm'],
+                      'xrot': record['xrot'], 'yrot': record['yrot'], 'zrot': record['zrot'],
+                      'coor_src': array(record['coor_src']).astype("float32"),
+                      'coor_trgt': array(record['coor_trgt']).astype("float32")}
+            completed[candidate_key(result['coor_src'], result['coor_trgt'],
+                                    result['xrot'], result['yrot'], result['zrot'])] = result
+    return completed
+
+def write_checkpoint(f, run_key, result):
+    record = dict(result, run=run_key,
+                  coor_src=[float(c) for c in result['coor_src']],
+                  coor_trgt=[float(c) for c in result['coor_trgt']])
+    f.write(json.dumps(record) + "\n")
+    f.flush()
+
+def init_worker(run_tmpdir, profiling):
+    # runs in each worker process of the pool: give the worker its own
+    # temporary directory so that get_tempfile names cannot collide, and
+    # let it clean up after itself when the main process terminates the pool
+    global worker_tmpdir, profile
+    worker_tmpdir = "%s/worker_%s" % (run_tmpdir, os.getpid())
+    profile = [] if profiling else None
+    profile_stages[:] = []
+    profile_tempfiles[:] = []
+    signal.signal(signal.SIGTERM, worker_termtrapper)
+    # Ctrl-C is delivered to the whole process group; the main process
+    # deals with it by terminating the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def call_in_worker(function, item):
+    # also hands the worker's profile records for this item to the main process
+    start = len(profile) if profile is not None else 0
+    result = function(item)
+    return result, (profile[start:] if profile is not None else [])
+
+def map_in_workers(function, items, jobs):
+    # like map(), but spread over a pool of worker processes. Results are
+    # yielded in the order of the items
+    global active_pool
+    active_pool = multiprocessing.Pool(jobs, initializer=init_worker,
+                                       initargs=(get_tmpdir(), profile is not None))
+    try:
+        for result, records in active_pool.imap(functools.partial(call_in_worker, function), items):
+            if profile is not None:
+                profile.extend(records)
+            yield result
+        active_pool.close()
+    finally:
+        active_pool.terminate()
+        active_pool.join()
+        active_pool = None
+
+def voxel_sizes(image):
+    return sqrt((image['affine'][:3, :3] ** 2).sum(axis=0))
+
+def voxel_to_world(image, voxels):
+    return (voxels.dot(image['affine'][:3, :3].T) + image['affine'][:3, 3]).astype("float32")
+
+@profiled("cog")
+def get_centre_of_gravity_native(image):
+    # the in-memory equivalent of volume_cog: the intensity weighted
+    # centre of the image, in world coordinates
+    total = image['data'].sum()
+    cog = array([(image['data'].sum(axis=tuple(a for a in range(3) if a != axis))
+                  * arange(image['data'].shape[axis])).sum() / total
+                 for axis in range(3)])
+    return voxel_to_world(image, cog)
+
+def bimodal_threshold(data, bins=10000):
+    # the in-memory equivalent of mincstats -biModalT: the threshold that
+    # maximises the between-class variance of the histogram (Otsu)
+    counts, edges = histogram(data, bins=bins)
+    centres = (edges[:-1] + edges[1:]) / 2
+    below = cumsum(counts).astype('float64')
+    above = below[-1] - below
+    below_sum = cumsum(counts * centres)
+    with errstate(divide='ignore', invalid='ignore'):
+        between = below * above * (below_sum / below - (below_sum[-1] - below_sum) / above) ** 2
+    return edges[nanargmax(between) + 1]
+
+def find_peaks_native(image, data, min_distance):
+    # the in-memory equivalent of find_peaks -pos_only -min_distance: the
+    # positive local maxima of data, highest first, leaving out every peak
+    # closer than min_distance (mm) to a higher one. Returns world coordinates
+    sizes = voxel_sizes(image)
+    neighbourhood = 2 * ceil(min_distance / sizes).astype(int) + 1
+    candidates = (data == ndimage.maximum_filter(data, size=neighbourhood, mode='constant')) & (data > 0)
+    voxels = argwhere(candidates)
+    voxels = voxels[argsort(-data[candidates], kind='stable')]
+    peaks = []
+    for voxel in voxels:
+        if not peaks or (sqrt((((array(peaks) - voxel) * sizes) ** 2).sum(axis=1)) >= min_distance).all():
+            peaks.append(voxel)
+    return [voxel_to_world(image, peak) for peak in peaks]
+
+@profiled("peaks")
+def get_distance_transform_peaks_native(image, peak_distance):
+    # see get_distance_transform_peaks
+    data = image['data']
+    inside = (data >= bimodal_threshold(data)) & (data <= data.max())
+    distance_transform = ndimage.distance_transform_edt(inside, sampling=voxel_sizes(image))
+    return find_peaks_native(image, distance_transform, peak_distance)
+
+@profiled("peaks")
+def get_blur_peaks_native(image, blur_kernel, peak_distance):
+    # see get_blur_peaks; blur_kernel is the FWHM (mm) of the Gaussian, as for mincblur
+    sigma = blur_kernel / (2 * sqrt(2 * log(2))) / voxel_sizes(image)
+    blurred = ndimage.gaussian_filter(image['data'], sigma=sigma, mode='constant')
+    return find_peaks_native(image, blurred, peak_distance)
+
+def get_seeds(image, name, *, stepsize, use_multiple_seeds, native_seeds=True):
+    # The centre of gravity of the image, and if we are using multiple
+    # seeds, the list of possible seeds in the image. The distance
+    # between peaks is based on the stepsize used for the
+    # registrations. With native_seeds, everything is computed
+    # from the image in memory rather than by volume_cog, mincstats,
+    # mincmorph, mincblur and find_peaks
+    if native_seeds:
+        loaded_image = load_image(image)
+        get_cog = functools.partial(get_centre_of_gravity_native, loaded_image)
+        get_dt_peaks = functools.partial(get_distance_transform_peaks_native, loaded_image)
+        get_blurred_peaks = functools.partial(get_blur_peaks_native, loaded_image)
+    else:
+        get_cog = functools.partial(get_centre_of_gravity, image)
+        get_dt_peaks = functools.partial(get_distance_transform_peaks, input_file=image)
+        get_blurred_peaks = functools.partial(get_blur_peaks, input_file=image)
+    cog = get_cog()
+    peaks = []
+    if use_multiple_seeds:
+        peaks = get_dt_peaks(peak_distance=stepsize)
+        print("\n\nPeaks found in the %s image (Distance Transform):" % name)
+        for coor in peaks:
+            print(coor)
+        # also add peaks from the blurred version of the input file
+        blurred_peaks = get_blurred_peaks(blur_kernel=stepsize, peak_distance=stepsize)
+        print("\n\nPeaks found in the %s image (blurred image):" % name)
+        for coor in blurred_peaks:
+            print(coor)
+            peaks.append(coor)
+        # also add the center of gravity of the image
+        peaks.append(cog)
+    return cog, peaks
+
 def loop_rotations(*, stepsize, source, target, source_mask, target_mask,
                    simplex, start=50, interval=10,
                    wtranslations="0.2,0.2,0.2", use_multiple_seeds=True, max_number_seeds=5,
-                   use_lsq12_for_alignment=False):
+                   use_lsq12_for_alignment=False, jobs=1, in_memory_seed_scoring=True,
+                   prescreen_top_k=None, prescreen_margin=None,
+                   checkpoint=None, checkpoint_key=None, resume=False,
+                   source_seeds=None, target_seeds=None, native_seeds=True,
+                   rotation_sampling="euler", rotation_tolerance=None):
     # load the mask volumes
     target_maskvol = volumeFromFile(target_mask) if target_mask is not None else None
     source_maskvol = volumeFromFile(source_mask) if source_mask is not None else None
@@ -183,7 +668,7 @@ def loop_rotations(*, stepsize, source, target, source_mask, target_mask,
     for maskvol in target_maskvol, source_maskvol:
       if (maskvol is not None) and math.isnan(maskvol.data.sum()):
         # clean up...
-        shutil.rmtree("%s/rot_%s" % (os.environ["TMPDIR"], os.getpid()))
+        shutil.rmtree(get_tmpdir())
         raise ValueError(
             "\n\n* * * * * * * * * *\n"
             "Error: the mask volume is corrupted. No values are found inside the mask.\n"
@@ -195,38 +680,22 @@ def loop_rotations(*, stepsize, source, target, source_mask, target_mask,
 
     # 1) The default way of aligning files is by using the centre
     #    of gravity of the input files
-    cog_source = get_centre_of_gravity(source)
-    cog_target = get_centre_of_gravity(target)
+    # 2) If we are using multiple seeds, calculate possible
+    #    seeds for both source and target images (see get_seeds).
+    #    In batch mode the target's seeds are computed only once
+    if source_seeds is None:
+        source_seeds = get_seeds(source, "source", stepsize=stepsize,
+                                 use_multiple_seeds=use_multiple_seeds,
+                                 native_seeds=native_seeds)
+    if target_seeds is None:
+        target_seeds = get_seeds(target, "target", stepsize=stepsize,
+                                 use_multiple_seeds=use_multiple_seeds,
+                                 native_seeds=native_seeds)
+    cog_source, list_source_peaks = source_seeds
+    cog_target, list_target_peaks = target_seeds
     list_of_coordinate_pairs = [[cog_source, cog_target]]
 
-    # 2) If we are using multiple seeds, calculate possible
-    #    seeds for both source and target images. The distance
-    #    between peaks is based on the stepsize used for the
-    #    registrations
     if use_multiple_seeds:
-        list_source_peaks = get_distance_transform_peaks(input_file=source, peak_distance=stepsize)
-        print("\n\nPeaks found in the source image (Distance Transform):")
-        for coor_src in list_source_peaks:
-            print(coor_src)
-        # also add peaks from the blurred version of the input file
-        blurred_peaks_source = get_blur_peaks(input_file=source, blur_kernel=stepsize, peak_distance=stepsize)
-        print("\n\nPeaks found in the source image (blurred image):")
-        for coor_src in blurred_peaks_source:
-            print(coor_src)
-            list_source_peaks.append(coor_src)
-        # also add the center of gravity of the source image
-        list_source_peaks.append(cog_source)
-        list_target_peaks = get_distance_transform_peaks(input_file=target, peak_distance=stepsize)
-        print("\n\nPeaks found in the target image (Distance Transform):")
-        for coor_trgt in list_target_peaks:
-            print(coor_trgt)
-        blurred_peaks_target = get_blur_peaks(input_file=target, blur_kernel=stepsize, peak_distance=stepsize)
-        print("\n\nPeaks found in the target image (blurred image):")
-        for coor_target in blurred_peaks_target:
-            print(coor_target)
-            list_target_peaks.append(coor_target)
-        # same for the target; add the center of gravity:
-        list_target_peaks.append(cog_target)
         for source_coor in list_source_peaks:
             for target_coor in list_target_peaks:
                 list_of_coordinate_pairs.append([source_coor, target_coor])
@@ -236,11 +705,19 @@ def loop_rotations(*, stepsize, source, target, source_mask, target_mask,
         #    the pairs based on that
         pairs_with_xcorr = []
         if len(list_of_coordinate_pairs) > max_number_seeds:
-            for coor_pair in list_of_coordinate_pairs:
-                xcorr_coor_pair = get_cross_correlation_from_coordinate_pair(
-                                    source_img=source, target_img=target,
-                                    mask_img=target_mask,  # TODO union with source mask ??  maybe not
-                                    coordinate_pair=coor_pair)
+            if in_memory_seed_scoring:
+                seed_xcorrs = get_cross_correlations_from_coordinate_pairs(
+                                source, target,
+                                target_mask,  # TODO union with source mask ??  maybe not
+                                list_of_coordinate_pairs)
+            else:
+                score = functools.partial(get_cross_correlation_from_coordinate_pair,
+                                          source, target, target_mask)
+                if jobs > 1:
+                    seed_xcorrs = map_in_workers(score, list_of_coordinate_pairs, jobs)
+                else:
+                    seed_xcorrs = map(score, list_of_coordinate_pairs)
+            for coor_pair, xcorr_coor_pair in zip(list_of_coordinate_pairs, seed_xcorrs):
                 #if xcorr_coor_pair > min(pairs_with_xcorr):
                 #  pairs_with_xcorr.pop(0)
                 #  # - pop previous nth_best and insert new coord pair and xcorr into pairs_with_xcorr
@@ -258,53 +735,75 @@ def loop_rotations(*, stepsize, source, target, source_mask, target_mask,
             print("\n\nNew list of coordinates:")
             print(list_of_coordinate_pairs)
 
+    # every (seed pair, rotation) combination is an independent registration;
+    # they are evaluated in this order, and the results are reduced in the
+    # same order, so the best result does not depend on the number of jobs
+    rotations = get_rotations(start, interval, sampling=rotation_sampling,
+                              tolerance=rotation_tolerance)
+    print("\n\nUsing %d rotations per seed pair\n" % len(rotations))
+    candidates = [(coordinates_src_target[0], coordinates_src_target[1], x, y, z)
+                  for coordinates_src_target in list_of_coordinate_pairs
+                  for x, y, z in rotations]
+    if prescreen_top_k is not None or prescreen_margin is not None:
+        candidates = prescreen_candidates(candidates, source=source, target=target,
+                                          target_mask=target_mask,
+                                          top_k=prescreen_top_k, margin=prescreen_margin)
+    completed = {}
+    if checkpoint is not None and resume:
+        completed = read_checkpoint(checkpoint, checkpoint_key)
+    todo = [candidate for candidate in candidates if candidate_key(*candidate) not in completed]
+    print("\n\nEvaluating %d rotations (%d taken from the checkpoint)\n"
+          % (len(candidates), len(candidates) - len(todo)))
+
+    evaluate = functools.partial(evaluate_rotation,
+                                 stepsize=stepsize, source=source, target=target,
+                                 source_mask=source_mask, target_mask=target_mask,
+                                 simplex=simplex, wtranslations=wtranslations,
+                                 use_lsq12_for_alignment=use_lsq12_for_alignment)
+    if jobs > 1:
+        new_results = map_in_workers(evaluate, todo, jobs)
+    else:
+        new_results = map(evaluate, todo)
+
+    checkpoint_file = None
+    if checkpoint is not None:
+        checkpoint_file = open(checkpoint, 'a+')
+        # start on a fresh line if a previous run was killed halfway through a record
+        if checkpoint_file.tell() > 0:
+            checkpoint_file.seek(checkpoint_file.tell() - 1)
+            if checkpoint_file.read(1) != "\n":
+                checkpoint_file.write("\n")
     best = { 'xcorr' : 0 }
-    for coordinates_src_target in list_of_coordinate_pairs:
-        coor_src = coordinates_src_target[0]
-        coor_trgt = coordinates_src_target[1]
-        for x in range(-start, start+1, interval):
-            for y in range(-start, start+1, interval):
-                for z in range(-start, start+1, interval):
-                    # we need to include the centre of the volume as rotation centre = cog1
-                    init_transform = create_transform(coor_trgt - coor_src, x, y, z, coor_src)
-                    init_resampled = resample_volume(source, target, init_transform)
-                    transform = minctracc(init_resampled, target,
-                                          source_mask=source_mask, target_mask=target_mask,
-                                          stepsize=stepsize,
-                                          wtranslations=wtranslations, simplex=simplex,
-                                          use_lsq12_for_alignment=use_lsq12_for_alignment)
-                    resampled = resample_volume(init_resampled, target, transform)
-                    conc_transform = concat_transforms(init_transform, transform)
-                    xcorr = compute_xcorr(resampled, target, maskfile=target_mask)
-                    if isnan(xcorr):
-                        xcorr = 0
-                    if xcorr > best['xcorr']:
-                        best = {'xcorr': xcorr, 'transform': conc_transform,
-                                'resampled': resampled,
-                                'xrot': x, 'yrot': y, 'zrot': z,
-                                'coor_src' : coor_src, 'coor_trgt' : coor_trgt }
-                    # had some issues with the resampled file being gone...
-                    # we'll just resample the final file only at the end
-                    os.remove(resampled)
-                    os.remove(init_resampled)
-                    os.remove(conc_transform)
-                    os.remove(init_transform)
-                    os.remove(transform)
-                    print("FINISHED: %s %s %s :: %s" % (x,y,z, xcorr))
+    for candidate in candidates:
+        key = candidate_key(*candidate)
+        if key in completed:
+            result = dict(completed[key])
+        else:
+            result = next(new_results)
+            if checkpoint_file is not None:
+                write_checkpoint(checkpoint_file, checkpoint_key, result)
+        del result['xfm']
+        if result['xcorr'] > best['xcorr']:
+            best = result
+    # all new results have been used; this lets the worker pool shut down
+    next(new_results, None)
+    if checkpoint_file is not None:
+        checkpoint_file.close()
 
     # resample the best result:
     # TODO this is the same code as the inner loop above -- make a procedure?
-    best_init_transform = create_transform(best['coor_trgt'] - best['coor_src'],
-                                           best['xrot'], best['yrot'], best['zrot'],
-                                           best['coor_src'])
-    best_init_resampled = resample_volume(source, target, best_init_transform)
-    best_transform = minctracc(best_init_resampled, target=target,
-                               source_mask=source_mask, target_mask=target_mask, stepsize=stepsize,
-                               wtranslations=wtranslations, simplex=simplex,
-                               use_lsq12_for_alignment=use_lsq12_for_alignment)
-    best_resampled = resample_volume(best_init_resampled, target, best_transform)
-    best_conc_transform = concat_transforms(best_init_transform, best_transform)
-    final_resampled = resample_volume(source, target, best_conc_transform)
+    with profiled("final"):
+        best_init_transform = create_transform(best['coor_trgt'] - best['coor_src'],
+                                               best['xrot'], best['yrot'], best['zrot'],
+                                               best['coor_src'])
+        best_init_resampled = resample_volume(source, target, best_init_transform)
+        best_transform = minctracc(best_init_resampled, target=target,
+                                   source_mask=source_mask, target_mask=target_mask, stepsize=stepsize,
+                                   wtranslations=wtranslations, simplex=simplex,
+                                   use_lsq12_for_alignment=use_lsq12_for_alignment)
+        best_resampled = resample_volume(best_init_resampled, target, best_transform)
+        best_conc_transform = concat_transforms(best_init_transform, best_transform)
+        final_resampled = resample_volume(source, target, best_conc_transform)
     #final_resampled = resample_volume(source, target, results[-1]["transform"])
     best["resampled"] = final_resampled
     best["transform"] = best_conc_transform
@@ -320,19 +819,100 @@ def extract_xcorr(adict):
 def sort_results(results, reverse_order=False):
     results.sort(key=extract_xcorr, reverse=reverse_order)
 
+@profiled("downsample")
 def downsample(infile, stepsize):
     output = get_tempfile(".mnc")
-    subprocess.check_call(("autocrop -isostep %s %s %s" % (stepsize, infile, output)).split())
+    check_call(("autocrop -isostep %s %s %s" % (stepsize, infile, output)).split())
     return output
 
+def read_batch_file(batch_file):
+    # one row per source, with the columns
+    # source,source_mask,output_xfm,output_mnc (source_mask may be empty)
+    with open(batch_file) as f:
+        sources = list(csv.DictReader(f))
+    for row in sources:
+        row['source_mask'] = row.get('source_mask') or None
+    return sources
+
+def align_source(entry, *, target, target_seeds, options, jobs):
+    # run the rotational search for a single source against the (downsampled)
+    # target, and write the best transform and resampled source
+    global source_tmpdir
+    if options.batch is not None:
+        source_tmpdir = "%s/source_%s" % (get_tmpdir(), os.path.basename(entry['output_xfm']))
+    try:
+        source = entry['source']
+        source_mask = entry['source_mask']
+        checkpoint_key = None
+        if options.checkpoint is not None:
+            checkpoint_key = get_run_key(
+                [source, options.target, source_mask, options.original_target_mask],
+                {'resamplestepsize': options.resamplestepsize,
+                 'registrationstepsize': options.registrationstepsize,
+                 'wtranslations': options.wtranslations,
+                 'simplex': options.simplex,
+                 'use_multiple_seeds': options.use_multiple_seeds,
+                 'max_number_seeds': options.max_number_seeds,
+                 'in_memory_seed_scoring': options.in_memory_seed_scoring,
+                 'native_seeds': options.native_seeds,
+                 'use_lsq12_for_alignment': options.use_lsq12_for_alignment})
+
+        if options.resamplestepsize:
+            source = downsample(source, options.resamplestepsize)
+            # downsample the mask only if it is specified
+            if source_mask:
+                source_mask = downsample(source_mask, options.resamplestepsize)
+
+        best = loop_rotations(stepsize=options.registrationstepsize,
+                              source=source,
+                              target=target,
+                              source_mask=source_mask,
+                              target_mask=options.target_mask,
+                              start=options.range,
+                              interval=options.interval,
+                              wtranslations=options.wtranslations,
+                              simplex=options.simplex,
+                              use_multiple_seeds=options.use_multiple_seeds,
+                              max_number_seeds=options.max_number_seeds,
+                              use_lsq12_for_alignment=options.use_lsq12_for_alignment,
+                              jobs=jobs,
+                              in_memory_seed_scoring=options.in_memory_seed_scoring,
+                              prescreen_top_k=options.prescreen_top_k,
+                              prescreen_margin=options.prescreen_margin,
+                              checkpoint=options.checkpoint,
+                              checkpoint_key=checkpoint_key,
+                              resume=options.resume,
+                              target_seeds=target_seeds,
+                              native_seeds=options.native_seeds,
+                              rotation_sampling=options.rotation_sampling,
+                              rotation_tolerance=options.rotation_tolerance)
+
+        print(best)
+        subprocess.check_call(("cp %s %s" % (best["transform"], entry['output_xfm'])).split())
+        subprocess.check_call(("cp %s %s" % (best["resampled"], entry['output_mnc'])).split())
+    finally:
+        if options.batch is not None:
+            shutil.rmtree(source_tmpdir, ignore_errors=True)
+            source_tmpdir = None
+
 # clean up tmp on soft kill signal
 def termtrapper(signum, frame):
     print("got kill signal", file=sys.stderr)
-    shutil.rmtree("%s/rot_%s" % (os.environ["TMPDIR"], os.getpid()))
+    # stop the workers first; each of them removes its own temporary
+    # directory, and whatever is left is removed with the main one
+    if active_pool is not None:
+        active_pool.terminate()
+    shutil.rmtree(get_run_tmpdir(), ignore_errors=True)
     exit("Went down gracefully!")
 
+def worker_termtrapper(signum, frame):
+    shutil.rmtree(worker_tmpdir, ignore_errors=True)
+    os._exit(1)
+
 
 def main(args):
+    global profile
+    start_wall, start_cpu = time.time(), cpu_time()
     # handle soft kill signal to clean up tmp
     signal.signal(signal.SIGTERM, termtrapper)
     signal.signal(signal.SIGINT, termtrapper)
@@ -359,6 +939,16 @@ def main(args):
     parser.add_argument("-i", "--interval", dest="interval",
                         help="interval (in degrees) to search across range [default = %(default)s]",
                         type=int, default=10)
+    parser.add_argument("--rotation-sampling", dest="rotation_sampling",
+                        choices=["euler", "uniform"], default="euler",
+                        help="How to sample the rotations within the range: 'euler' steps through "
+                             "the x, y and z rotations separately; 'uniform' uses a near-uniform "
+                             "sampling of all rotations by at most --range degrees, with the "
+                             "spacing of --interval degrees, which needs far fewer starting "
+                             "points for the same coverage [default = %(default)s]")
+    parser.add_argument("--rotation-tolerance", dest="rotation_tolerance", type=float, default=None,
+                        help="With --rotation-sampling uniform, leave out rotations within this "
+                             "many degrees of one already used [default: half the interval]")
     parser.add_argument("-w", "--wtranslations", dest="wtranslations",
                         help="Comma separated list of optimization weights of translations in "
                              "x, y, z for minctracc [default = %(default)s]",
@@ -379,6 +969,37 @@ def main(args):
                         "pairs are ordered based on the cross correlation gotten "
                         "from the alignment based on only the translation from the "
                         "seed point. [default = %(default)s]")
+    parser.set_defaults(native_seeds=True)
+    parser.add_argument("--native-seeds", dest="native_seeds", action="store_true",
+                        help="Compute the centres of gravity and the seed peaks (bimodal threshold, "
+                             "distance transform, blurring and peak finding) in memory, rather than "
+                             "with volume_cog, mincstats, mincmorph, mincblur and find_peaks. "
+                             "[default = %(default)s]")
+    parser.add_argument("--no-native-seeds", dest="native_seeds", action="store_false",
+                        help="Opposite of --native-seeds")
+    parser.set_defaults(in_memory_seed_scoring=True)
+    parser.add_argument("--in-memory-seed-scoring", dest="in_memory_seed_scoring", action="store_true",
+                        help="Rank the seed pairs by resampling the (downsampled) source and computing "
+                             "the cross correlation in memory, instead of running param2xfm, "
+                             "mincresample and minccmp for every pair. [default = %(default)s]")
+    parser.add_argument("--no-in-memory-seed-scoring", dest="in_memory_seed_scoring", action="store_false",
+                        help="Opposite of --in-memory-seed-scoring")
+    parser.add_argument("--prescreen-top-k", dest="prescreen_top_k", type=int, default=None,
+                        help="Before running minctracc, score every (seed pair, rotation) "
+                             "starting point by its cross correlation after a rigid resampling "
+                             "in memory, and only register the best K of them. Can be combined "
+                             "with --prescreen-margin. [default: no prescreen]")
+    parser.add_argument("--prescreen-margin", dest="prescreen_margin", type=float, default=None,
+                        help="Only register the starting points whose prescreen cross correlation "
+                             "is within this margin of the best one (see --prescreen-top-k). "
+                             "[default: no prescreen]")
+    parser.add_argument("--checkpoint", dest="checkpoint", type=str, default=None,
+                        help="Record the result of every evaluated (seed pair, rotation) in this "
+                             "file, so that an interrupted run can be continued with --resume")
+    parser.add_argument("--resume", dest="resume", action="store_true", default=False,
+                        help="Skip the rotations already recorded in the --checkpoint file for the "
+                             "same input files, masks and registration options. This also reuses "
+                             "the results of a run with a different --range or --interval.")
     parser.set_defaults(use_lsq12_for_alignment=False)
 
     parser.add_argument("--use-lsq12-for-alignment", dest="use_lsq12_for_alignment", action="store_true",
@@ -386,12 +1007,42 @@ def main(args):
                              "use 3 scaling parameters as well. [default = %(default)s]")
     parser.add_argument("--no-use-lsq12-for-alignment", dest="use_lsq12_for_alignment", action="store_false",
                         help="Opposite of --use-lsq12-for-alignment")
-    parser.add_argument("source", help="", type=str, metavar="source.mnc")
-    parser.add_argument("target", help="", type=str, metavar="target.mnc")
-    parser.add_argument("output_xfm", help="", type=str, metavar="output.xfm")
-    parser.add_argument("output_mnc", help="", type=str, metavar="output.mnc")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                        help="Number of processes used to evaluate the rotations "
+                             "(and seed pairs) in parallel [default = %(default)s]")
+    parser.add_argument("--profile-json", dest="profile_json", type=str, default=None,
+                        metavar="out.json",
+                        help="Write the wall time, cpu time and bytes written to TMPDIR of every "
+                             "stage and of every tool invoked to this file, along with totals per "
+                             "stage and per tool")
+    parser.add_argument("--batch", dest="batch", type=str, default=None, metavar="sources.csv",
+                        help="Align every source listed in this CSV file (with the columns source, "
+                             "source_mask, output_xfm and output_mnc; source_mask may be left empty) "
+                             "to the same target. The target is downsampled and its seeds are "
+                             "computed only once, and the sources are spread over the --jobs "
+                             "workers. The only positional argument is then target.mnc")
+    parser.add_argument("files", nargs="+", type=str, metavar="file",
+                        help="source.mnc target.mnc output.xfm output.mnc, "
+                             "or only target.mnc with --batch")
 
-    options = parser.parse_args()
+    options = parser.parse_args(args)
+
+    if options.resume and options.checkpoint is None:
+        parser.error("--resume requires --checkpoint")
+    if options.batch is None:
+        if len(options.files) != 4:
+            parser.error("expected source.mnc target.mnc output.xfm output.mnc")
+        options.source, options.target, output_xfm, output_mnc = options.files
+    else:
+        if len(options.files) != 1:
+            parser.error("expected only target.mnc with --batch")
+        if options.source_mask is not None:
+            parser.error("specify the source masks in the --batch file")
+        options.target, = options.files
+        sources = read_batch_file(options.batch)
+    options.original_target_mask = options.target_mask
+    if options.profile_json is not None:
+        profile = []
 
     if options.tmpdir:
         os.environ["TMPDIR"] = options.tmpdir
@@ -400,37 +1051,35 @@ def main(args):
 
     print("TMP: %s" % os.environ["TMPDIR"])
     print("RANGE: %s INTERVAL: %s" % (options.range, options.interval))
-    source     = options.source
-    target     = options.target
-    output_xfm = options.output_xfm
-    output_mnc = options.output_mnc
+    target = options.target
 
     if options.resamplestepsize:
-        source = downsample(options.source, options.resamplestepsize)
         target = downsample(options.target, options.resamplestepsize)
         # downsample the mask only if it is specified
         if options.target_mask:
             options.target_mask = downsample(options.target_mask, options.resamplestepsize)
-        if options.source_mask:
-            options.source_mask = downsample(options.source_mask, options.resamplestepsize)
-
-    best = loop_rotations(stepsize=options.registrationstepsize,
-                          source=source,
-                          target=target,
-                          source_mask=options.source_mask,
-                          target_mask=options.target_mask,
-                          start=options.range,
-                          interval=options.interval,
-                          wtranslations=options.wtranslations,
-                          simplex=options.simplex,
-                          use_multiple_seeds=options.use_multiple_seeds,
-                          max_number_seeds=options.max_number_seeds,
-                          use_lsq12_for_alignment=options.use_lsq12_for_alignment)
-
-    print(best)
-    subprocess.check_call(("cp %s %s" % (best["transform"], output_xfm)).split())
-    subprocess.check_call(("cp %s %s" % (best["resampled"], output_mnc)).split())
-    shutil.rmtree("%s/rot_%s" % (os.environ["TMPDIR"], os.getpid()))
+
+    if options.batch is None:
+        align_source({'source': options.source, 'source_mask': options.source_mask,
+                      'output_xfm': output_xfm, 'output_mnc': output_mnc},
+                     target=target, target_seeds=None, options=options, jobs=options.jobs)
+    else:
+        # the target side (downsampling, centre of gravity and peaks) is
+        # shared by all sources; the sources are spread over the workers
+        target_seeds = get_seeds(target, "target", stepsize=options.registrationstepsize,
+                                 use_multiple_seeds=options.use_multiple_seeds,
+                                 native_seeds=options.native_seeds)
+        align = functools.partial(align_source, target=target, target_seeds=target_seeds,
+                                  options=options, jobs=1)
+        if options.jobs > 1:
+            list(map_in_workers(align, sources, options.jobs))
+        else:
+            list(map(align, sources))
+    shutil.rmtree(get_tmpdir())
+
+    if profile is not None:
+        with open(options.profile_json, 'w') as f:
+            json.dump(profile_summary(time.time() - start_wall, cpu_time() - start_cpu), f, indent=2)
 
 
 if __name__ == "__main__":
@@ -14,6 +14,7 @@ setup(name="python-stuffs",
                "minc_label_ops",
                "compute_values_across_segmentation",
                "volumes_from_labels_only",
+               "label_volumes_from_jacobians_batch",
                "voxel_vote",
                "replace_label_with_nearest_valid_label",
                "rotational_minctracc.py",
@@ -0,0 +1,74 @@
+import importlib.machinery
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python")
+
+
+def script_path(name):
+    return os.path.join(SCRIPTS, name)
+
+
+def pyminc_factory():
+    """pyminc's volume factory; tests that read or write MINC files are
+    skipped where pyminc (or the libminc it loads) is not installed"""
+    try:
+        from pyminc.volumes import factory
+    except (ImportError, OSError):
+        pytest.skip("needs pyminc and libminc")
+    return factory
+
+
+def requires_tools(*tools):
+    for tool in tools:
+        if shutil.which(tool) is None:
+            pytest.skip("needs %s" % tool)
+
+
+def load_script(name):
+    """imports one of the scripts in python/ (most have no .py extension)
+    as a module, without running its main part"""
+    pyminc_factory()
+    loader = importlib.machinery.SourceFileLoader(name.replace(".", "_"), script_path(name))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def run_script(name, *args):
+    """runs one of the scripts in python/ and returns its standard output"""
+    pyminc_factory()
+    result = subprocess.run([sys.executable, script_path(name)] + [str(a) for a in args],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise AssertionError("%s %s failed:\n%s" % (name, " ".join(map(str, args)), result.stderr))
+    return result.stdout
+
+
+def write_volume(filename, data, volumeType="double", labels=False, steps=(1, 1, 1),
+                 dimnames=("zspace", "yspace", "xspace"), starts=None, **cosines):
+    factory = pyminc_factory()
+    data = np.asarray(data, dtype=np.float64)
+    vol = factory.volumeFromData(str(filename), data, dimnames=dimnames,
+                                 starts=starts if starts is not None else (0,) * data.ndim,
+                                 steps=steps, volumeType=volumeType, dtype="double",
+                                 labels=labels, **cosines)
+    vol.writeFile()
+    vol.closeVolume()
+    return str(filename)
+
+
+def read_volume(filename):
+    factory = pyminc_factory()
+    vol = factory.volumeFromFile(str(filename), dtype="double")
+    data = np.array(vol.data)
+    vol.closeVolume()
+    return data
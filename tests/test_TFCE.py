@@ -0,0 +1,117 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from helpers import load_script
+
+
+@pytest.fixture(scope="module")
+def tfce():
+    return load_script("TFCE")
+
+
+def smooth_map(shape, seed):
+    rng = np.random.default_rng(seed)
+    return ndimage.gaussian_filter(rng.standard_normal(shape), 1.5) * 8
+
+
+@pytest.mark.parametrize("negative", [False, True])
+@pytest.mark.parametrize("dh", [0.1, 0.037])
+def test_engines_agree(tfce, negative, dh):
+    for seed, shape in enumerate([(12, 10, 9), (1, 15, 15), (20, 6, 7)]):
+        data = smooth_map(shape, seed)
+        expected = tfce.tfce_levels(data, 0.3, dh=dh, E=0.6, H=1.8, negative=negative)
+        actual = tfce.tfce_maxtree(data, 0.3, dh=dh, E=0.6, H=1.8, negative=negative)
+        assert np.abs(expected).max() > 0
+        np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-9 * np.abs(expected).max())
+
+
+def test_engines_agree_inside_a_mask(tfce):
+    data = smooth_map((14, 12, 11), 7)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[2:11, 1:9, 3:10] = True
+    mask[5:8, 4:6, :] = False
+    expected = tfce.enhance(data, 0.5, "both", engine="levels", mask=mask)
+    actual = tfce.enhance(data, 0.5, "both", engine="maxtree", mask=mask)
+    assert not expected[~mask].any()
+    np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-9 * np.abs(expected).max())
+
+
+def test_plateaus_and_ties(tfce):
+    # many voxels at exactly the same values, and values right on a level
+    data = np.zeros((6, 7, 8))
+    data[1:3, 1:4, 1:3] = 1.0
+    data[3:5, 2:6, 4:7] = 0.5
+    data[2, 3, 2:5] = 0.3
+    expected = tfce.tfce_levels(data, 1.0)
+    np.testing.assert_allclose(tfce.tfce_maxtree(data, 1.0), expected, rtol=1e-9)
+
+
+def test_batch_closes_every_3d_map(tfce, tmp_path, monkeypatch):
+    from helpers import write_volume
+    maps = [smooth_map((8, 9, 7), seed) for seed in range(5)]
+    files = [write_volume(tmp_path / ("map%d.mnc" % i), m) for i, m in enumerate(maps[:3])]
+    files.append(write_volume(tmp_path / "maps.mnc", np.stack(maps[3:]),
+                              dimnames=("time", "zspace", "yspace", "xspace"), steps=(1, 1, 1, 1)))
+
+    opened, closed = [], []
+    volumeFromFile = tfce.vf.volumeFromFile
+    def tracked(filename, *args, **kwargs):
+        vol = volumeFromFile(filename, *args, **kwargs)
+        close = vol.closeVolume
+        def closeVolume():
+            closed.append(vol)
+            close()
+        vol.closeVolume = closeVolume
+        opened.append((filename, vol))
+        return vol
+    monkeypatch.setattr(tfce.vf, "volumeFromFile", tracked)
+
+    tfce.init_batch({"maps": tfce.batch_maps(files), "voxvol": 1.0, "mask": None, "signs": "both",
+                     "dh": 0.1, "E": 0.5, "H": 2.0, "engine": "levels", "prefix": None,
+                     "verbose": False})
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        extremes = [tfce.batch_map(k) for k in range(len(maps))]
+    # the levels engine only reports its levels when verbose
+    assert output.getvalue() == ""
+    expected = [tfce.enhance(m, 1.0) for m in maps]
+    np.testing.assert_allclose(extremes, [(e.max(), e.min()) for e in expected], rtol=1e-6)
+
+    # only the 4D file stays open, to read its other maps from
+    assert list(tfce.batch_volhandles) == [files[3]]
+    assert [f for f, vol in opened if vol not in closed] == [files[3]]
+    # which the worker closes as it exits
+    tfce.close_batch()
+    assert tfce.batch_volhandles == {}
+    assert [f for f, vol in opened if vol not in closed] == []
+    tfce.batch.clear()
+
+
+def test_batch_4d_outputs_keep_the_direction_cosines(tfce, tmp_path):
+    from helpers import read_volume, write_volume
+    pyminc = pytest.importorskip("pyminc.volumes.factory")
+    maps = np.stack([smooth_map((8, 9, 7), seed) for seed in range(2)])
+    cosines = {"x_dir_cosines": (0.8, 0.6, 0.0), "y_dir_cosines": (-0.6, 0.8, 0.0),
+               "z_dir_cosines": (0.0, 0.0, 1.0)}
+    infile = write_volume(tmp_path / "maps.mnc", maps, dimnames=("time", "zspace", "yspace", "xspace"),
+                          steps=(1, 1, 1, 1), **cosines)
+    tfce.init_batch({"maps": tfce.batch_maps([infile]), "voxvol": 1.0, "mask": None, "signs": "both",
+                     "dh": 0.1, "E": 0.5, "H": 2.0, "engine": "levels",
+                     "prefix": str(tmp_path / "enhanced"), "verbose": False})
+    for k in range(2):
+        tfce.batch_map(k)
+    tfce.close_batch()
+    tfce.batch.clear()
+
+    for k in range(2):
+        outfile = str(tmp_path / ("enhanced_%04d.mnc" % k))
+        np.testing.assert_allclose(read_volume(outfile), tfce.enhance(maps[k], 1.0), rtol=1e-5, atol=1e-6)
+        vol = pyminc.volumeFromFile(outfile)
+        for name in ("xspace", "yspace", "zspace"):
+            np.testing.assert_allclose(list(vol.get_direction_cosines(name))[0:3],
+                                       cosines[name[0] + "_dir_cosines"], atol=1e-6)
+        vol.closeVolume()
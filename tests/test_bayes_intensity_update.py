@@ -0,0 +1,64 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from helpers import pyminc_factory, read_volume, run_script, script_path, write_volume
+
+
+@pytest.fixture
+def population(tmp_path):
+    rng = np.random.default_rng(0)
+    popmean = rng.uniform(50, 100, size=(13, 7, 6))
+    popsd = rng.uniform(5, 10, size=popmean.shape)
+    return (write_volume(tmp_path / "popmean.mnc", popmean),
+            write_volume(tmp_path / "popsd.mnc", popsd), popmean, popsd)
+
+
+def expected(data, popmean, popsd, precision, n):
+    # the update as computed before it went slab by slab
+    q = n / popsd
+    return (data * precision + q * popmean) / (precision + q), precision / (precision + q)
+
+
+def test_update_and_weights(tmp_path, population):
+    popmeanfile, popsdfile, popmean, popsd = population
+    data = np.random.default_rng(1).uniform(40, 110, size=popmean.shape)
+    infile = write_volume(tmp_path / "input.mnc", data)
+    run_script("bayes_intensity_update", "-p", 0.5, "-n", 20, "--slab-slices", 4,
+               "-w", tmp_path / "weights.mnc", infile, popmeanfile, popsdfile, tmp_path / "output.mnc")
+
+    output, weights = expected(data, popmean, popsd, 0.5, 20)
+    np.testing.assert_allclose(read_volume(tmp_path / "output.mnc"), output, rtol=1e-6)
+    np.testing.assert_allclose(read_volume(tmp_path / "weights.mnc"), weights, rtol=1e-6)
+
+
+def test_batch_writes_the_weights_of_every_scan(tmp_path, population):
+    popmeanfile, popsdfile, popmean, popsd = population
+    rng = np.random.default_rng(2)
+    lines, scans = [], []
+    for i in range(3):
+        data = rng.uniform(40, 110, size=popmean.shape)
+        scans.append(data)
+        lines.append("%s,%s,%s" % (write_volume(tmp_path / ("input%d.mnc" % i), data),
+                                   tmp_path / ("output%d.mnc" % i), tmp_path / ("weights%d.mnc" % i)))
+    (tmp_path / "batch.txt").write_text("\n".join(lines) + "\n")
+    run_script("bayes_intensity_update", "-p", 2, "-n", 15, "-j", 2, "--batch", tmp_path / "batch.txt",
+               popmeanfile, popsdfile)
+
+    for i, data in enumerate(scans):
+        output, weights = expected(data, popmean, popsd, 2, 15)
+        np.testing.assert_allclose(read_volume(tmp_path / ("output%d.mnc" % i)), output, rtol=1e-6)
+        np.testing.assert_allclose(read_volume(tmp_path / ("weights%d.mnc" % i)), weights, rtol=1e-6)
+
+
+def test_batch_rejects_output_weight(tmp_path):
+    pyminc_factory()
+    (tmp_path / "batch.txt").write_text("in.mnc,out.mnc\n")
+    result = subprocess.run([sys.executable, script_path("bayes_intensity_update"), "-p", "1",
+                             "-w", str(tmp_path / "weights.mnc"), "--batch", str(tmp_path / "batch.txt"),
+                             "popmean.mnc", "popsd.mnc"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 2
+    assert "--batch" in result.stderr
@@ -0,0 +1,92 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from helpers import load_script, read_volume, script_path, write_volume
+
+STEPS = {"zspace": 0.3, "yspace": 0.5, "xspace": 0.7}
+ANGLE = np.radians(25)
+COSINES = {"xspace": [np.cos(ANGLE), np.sin(ANGLE), 0.0],
+           "yspace": [-np.sin(ANGLE), np.cos(ANGLE), 0.0],
+           "zspace": [0.0, 0.0, 1.0]}
+
+
+@pytest.fixture(scope="module")
+def cd():
+    return load_script("compute_determinant.py")
+
+
+def world_coordinates(shape):
+    z, y, x = np.meshgrid(*[np.arange(n) for n in shape], indexing="ij")
+    return sum(index[..., None] * STEPS[name] * np.array(COSINES[name])
+               for index, name in ((z, "zspace"), (y, "yspace"), (x, "xspace")))
+
+
+def write_field(filename, displacement):
+    # as minc_displacement writes them: the vector dimension last
+    write_volume(filename, displacement, dimnames=("zspace", "yspace", "xspace", "vector_dimension"),
+                 steps=(STEPS["zspace"], STEPS["yspace"], STEPS["xspace"], 1),
+                 x_dir_cosines=COSINES["xspace"], y_dir_cosines=COSINES["yspace"],
+                 z_dir_cosines=COSINES["zspace"])
+    write_volume(str(filename) + "_like.mnc", np.zeros(displacement.shape[:3]),
+                 steps=(STEPS["zspace"], STEPS["yspace"], STEPS["xspace"]),
+                 x_dir_cosines=COSINES["xspace"], y_dir_cosines=COSINES["yspace"],
+                 z_dir_cosines=COSINES["zspace"])
+    return str(filename), str(filename) + "_like.mnc"
+
+
+@pytest.mark.parametrize("log", [False, True])
+def test_affine_field(cd, tmp_path, log):
+    rng = np.random.default_rng(0)
+    matrix = np.eye(3) + 0.1 * rng.standard_normal((3, 3))
+    field, like = write_field(tmp_path / "field.mnc",
+                              world_coordinates((11, 9, 8)).dot((matrix - np.eye(3)).T))
+    cd.jacobian_determinant(field, like, str(tmp_path / "det.mnc"), log=log, nslices=3)
+    expected = np.linalg.det(matrix)
+    np.testing.assert_allclose(read_volume(tmp_path / "det.mnc"),
+                               np.full((11, 9, 8), np.log(expected) if log else expected), rtol=1e-9)
+
+
+def test_slabs_match_the_whole_volume(cd, tmp_path):
+    world = world_coordinates((13, 10, 9))
+    displacement = 0.2 * np.sin(world[..., [1, 2, 0]] * 1.3) * np.cos(world[..., [2, 0, 1]])
+    field, like = write_field(tmp_path / "field.mnc", displacement)
+    cd.jacobian_determinant(field, like, str(tmp_path / "det.mnc"), nslices=4)
+
+    gradient = np.stack([np.stack(np.gradient(displacement[..., k]), -1) for k in range(3)], -2)
+    steps = np.stack([STEPS[n] * np.array(COSINES[n]) for n in ("zspace", "yspace", "xspace")], 1)
+    expected = np.linalg.det(np.eye(3) + gradient.dot(np.linalg.inv(steps)))
+    np.testing.assert_allclose(read_volume(tmp_path / "det.mnc"), expected, rtol=1e-9)
+
+
+def test_compare_mincblob_needs_the_python_engine():
+    result = subprocess.run([sys.executable, script_path("compute_determinant.py"), "--compare-mincblob",
+                             "--like", "like.mnc", "--transform", "t.xfm", "--determinant", "det.mnc"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 2
+    assert "--engine python" in result.stderr
+
+
+def test_python_engine_needs_clobber_to_overwrite(tmp_path):
+    output = tmp_path / "det.mnc"
+    output.write_text("")
+    result = subprocess.run([sys.executable, script_path("compute_determinant.py"), "--engine", "python",
+                             "--like", "like.mnc", "--transform", "t.xfm", "--determinant", str(output)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 2
+    assert "--clobber" in result.stderr
+
+
+def test_single_slice_fields_are_rejected(cd, tmp_path):
+    field, like = write_field(tmp_path / "field.mnc", np.zeros((1, 6, 5, 3)))
+    with pytest.raises(ValueError, match="single sample along zspace"):
+        cd.jacobian_determinant(field, like, str(tmp_path / "det.mnc"))
+
+
+def test_like_must_match_the_field(cd, tmp_path):
+    field, _ = write_field(tmp_path / "field.mnc", np.zeros((7, 6, 5, 3)))
+    like = write_volume(tmp_path / "like.mnc", np.zeros((5, 6, 7)), dimnames=("xspace", "yspace", "zspace"))
+    with pytest.raises(ValueError, match="the displacement field 7x6x5"):
+        cd.jacobian_determinant(field, like, str(tmp_path / "det.mnc"))
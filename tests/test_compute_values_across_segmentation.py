@@ -0,0 +1,46 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from helpers import load_script, pyminc_factory, script_path, write_volume
+
+
+@pytest.fixture(scope="module")
+def cvas():
+    return load_script("compute_values_across_segmentation")
+
+
+def test_label_statistics_match_per_label_reductions(cvas):
+    rng = np.random.default_rng(0)
+    atlas = rng.choice([0, 1, 4, 9, 300], size=(9, 7, 6)).astype(np.uint16)
+    atlas[0, 0, 0] = 2  # a label of a single voxel
+    values = rng.normal(size=atlas.shape)
+    labels, order, starts = cvas.atlas_groups(atlas)
+    result = cvas.label_statistics(values, order, starts, cvas.statistics_names)
+
+    np.testing.assert_array_equal(labels, np.unique(atlas))
+    reductions = {"count": len, "sum": np.sum, "mean": np.mean, "std": np.std,
+                  "min": np.min, "max": np.max, "median": np.median}
+    for i, l in enumerate(labels):
+        for name, reduction in reductions.items():
+            np.testing.assert_allclose(result[name][i], reduction(values[atlas == l]),
+                                       rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_inputs_of_another_shape_are_rejected(tmp_path, batch):
+    pyminc_factory()
+    atlas = write_volume(tmp_path / "atlas.mnc", np.ones((4, 4, 4)), volumeType="ushort", labels=True)
+    infile = write_volume(tmp_path / "input.mnc", np.arange(80.0).reshape(5, 4, 4))
+    if batch:
+        (tmp_path / "inputs.txt").write_text(infile + "\n")
+        args = ["--batch", str(tmp_path / "inputs.txt")]
+    else:
+        args = [infile]
+    result = subprocess.run([sys.executable, script_path("compute_values_across_segmentation")] +
+                            args + [atlas, str(tmp_path / "output.txt")],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode != 0
+    assert "%s is 5x4x4 voxels, the atlas 4x4x4 voxels" % infile in result.stderr
@@ -0,0 +1,46 @@
+import subprocess
+import sys
+
+import numpy as np
+
+from helpers import pyminc_factory, run_script, script_path, write_volume
+
+
+def read_table(filename):
+    lines = open(filename).read().splitlines()
+    labels = [int(l) for l in lines[0].split(",")[1:]]
+    return labels, dict((line.split(",")[0], np.array([float(v) for v in line.split(",")[1:]]))
+                        for line in lines[1:])
+
+
+def test_volumes_per_subject_labels(tmp_path):
+    rng = np.random.default_rng(0)
+    steps = (0.5, 0.25, 2.0)
+    rows, expected = [], {}
+    for i in range(2):
+        labels = rng.choice([0, 2, 5], size=(7, 6, 5))
+        jacobians = rng.uniform(-0.3, 0.3, size=labels.shape)
+        labelfile = write_volume(tmp_path / ("labels%d.mnc" % i), labels, volumeType="ushort",
+                                 labels=True, steps=steps)
+        jacobianfile = write_volume(tmp_path / ("jacobians%d.mnc" % i), jacobians, steps=steps)
+        rows.append("%s,%s" % (jacobianfile, labelfile))
+        expected[jacobianfile] = [np.exp(jacobians[labels == l]).sum() * 0.25 for l in (0, 2, 5)]
+    (tmp_path / "inputs.txt").write_text("\n".join(rows) + "\n")
+    run_script("label_volumes_from_jacobians_batch", tmp_path / "inputs.txt", tmp_path / "volumes.csv")
+
+    labels, table = read_table(tmp_path / "volumes.csv")
+    assert labels == [0, 2, 5]
+    for subject, volumes in expected.items():
+        np.testing.assert_allclose(table[subject], volumes, rtol=1e-4)
+
+
+def test_labels_and_jacobians_of_different_sizes(tmp_path):
+    pyminc_factory()
+    labelfile = write_volume(tmp_path / "labels.mnc", np.ones((7, 6, 5)), volumeType="ushort", labels=True)
+    jacobianfile = write_volume(tmp_path / "jacobians.mnc", np.zeros((7, 6, 4)))
+    (tmp_path / "inputs.txt").write_text("%s,%s\n" % (jacobianfile, labelfile))
+    result = subprocess.run([sys.executable, script_path("label_volumes_from_jacobians_batch"),
+                             str(tmp_path / "inputs.txt"), str(tmp_path / "volumes.csv")],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode != 0
+    assert "subject %s" % jacobianfile in result.stderr
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from helpers import load_script, pyminc_factory, write_volume
+
+
+@pytest.fixture(scope="module")
+def mx():
+    return load_script("measure_xcorr")
+
+
+@pytest.fixture
+def volumes(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.normal(5, 1, size=(4, 11, 6, 5))
+    files = [write_volume(tmp_path / ("vol%d.mnc" % i), d) for i, d in enumerate(data)]
+    mask = write_volume(tmp_path / "mask.mnc", rng.random((11, 6, 5)) > 0.4)
+    return files, mask
+
+
+@pytest.mark.parametrize("masked", [False, True])
+def test_matrix_matches_pairwise_xcorr(mx, volumes, masked):
+    files, mask = volumes
+    mask = mask if masked else None
+    matrix = mx.compute_xcorr_matrix(files, mask, nslices=4)
+    factory = pyminc_factory()
+    for i, f in enumerate(files):
+        for j, g in enumerate(files):
+            source, target = factory.volumeFromFile(f), factory.volumeFromFile(g)
+            np.testing.assert_allclose(matrix[i, j], mx.compute_xcorr(source, target, mask), rtol=1e-12)
+            source.closeVolume()
+            target.closeVolume()
+
+
+@pytest.mark.parametrize("which", ["volume", "mask"])
+def test_sizes_must_match(mx, volumes, tmp_path, which):
+    files, mask = volumes
+    other = write_volume(tmp_path / "other.mnc", np.ones((12, 6, 5)))
+    if which == "volume":
+        files, mask = files + [other], None
+    else:
+        mask = other
+    with pytest.raises(ValueError, match="other.mnc is 12x6x5 voxels"):
+        mx.compute_xcorr_matrix(files, mask)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from helpers import read_volume, run_script, write_volume
+
+
+def baseline(option, value, labels, mask):
+    # what minc_label_ops wrote for each of these options on their own,
+    # before they were compiled into a lookup table
+    out = labels.copy()
+    if option == "--remap":
+        for pair in value.split(","):
+            source, target = pair.split(":")
+            first, last = (source.split("-") * 2)[:2] if "-" in source else (source, source)
+            for label in range(int(first), int(last) + 1):
+                out[labels == label] = int(target)
+    elif option == "--select":
+        out = np.zeros_like(labels)
+        for label in value.split(","):
+            out[labels == int(label)] = int(label)
+    elif option == "--remove":
+        for label in value.split(","):
+            out[labels == int(label)] = 0
+    elif option == "--mask":
+        out[mask > 0.5] = 0
+    elif option == "--binarize":
+        out = (labels > 0.5).astype(labels.dtype)
+    return out
+
+
+@pytest.mark.parametrize("option,value", [("--convert", None), ("--remap", "3:11,5-7:2,11:4"),
+                                          ("--select", "3,7,400"), ("--remove", "0,5,400"),
+                                          ("--mask", None), ("--binarize", None)])
+def test_single_options_match_the_baseline(tmp_path, option, value):
+    rng = np.random.default_rng(0)
+    labels = rng.choice([0, 3, 5, 6, 7, 11, 400], size=(23, 6, 5))
+    mask = (rng.uniform(size=labels.shape) > 0.5).astype(float)
+    infile = write_volume(tmp_path / "labels.mnc", labels, volumeType="ushort", labels=True)
+    maskfile = write_volume(tmp_path / "mask.mnc", mask)
+    args = [option] + ([value] if value is not None else [maskfile] if option == "--mask" else [])
+    run_script("minc_label_ops", "--slab-slices", 4, *(args + [infile, tmp_path / "out.mnc"]))
+
+    np.testing.assert_array_equal(read_volume(tmp_path / "out.mnc"),
+                                  baseline(option, value, labels, mask))
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from helpers import read_volume, run_script, write_volume
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.normal(10, 2, size=(7, 9, 8, 6))
+    data[:, 0] = 0
+    files = [write_volume(tmp_path / ("in%d.mnc" % i), d) for i, d in enumerate(data)]
+    return files, data
+
+
+@pytest.mark.parametrize("options", [[], ["--max-memory", "0.005"]])
+def test_group_size_matches_all_files_at_once(inputs, tmp_path, options):
+    files, data = inputs
+    weights = np.arange(1, len(files) + 1, dtype=float)
+    np.savetxt(str(tmp_path / "weights.txt"), weights)
+    run_script("pmincaverage", "--group-size", 3, "--jobs", 2, "--weights", tmp_path / "weights.txt",
+               "--sd", tmp_path / "sd.mnc", "--nonzero-count", tmp_path / "nonzero.mnc",
+               *(options + files + [tmp_path / "mean.mnc"]))
+
+    mean = np.average(data, axis=0, weights=weights)
+    var = (weights[:, None, None, None] * (data - mean) ** 2).sum(axis=0) / \
+        (weights.sum() - (weights ** 2).sum() / weights.sum())
+    np.testing.assert_allclose(read_volume(tmp_path / "mean.mnc"), mean, rtol=1e-3)
+    np.testing.assert_allclose(read_volume(tmp_path / "sd.mnc"), np.sqrt(var), rtol=1e-3, atol=1e-6)
+    np.testing.assert_array_equal(read_volume(tmp_path / "nonzero.mnc"), np.count_nonzero(data, axis=0))
+    assert not (tmp_path / "mean.mnc_partials").exists()
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from helpers import load_script
+
+UNWANTED = np.array([7, 9], dtype=np.uint16)
+
+
+@pytest.fixture(scope="module")
+def rl():
+    return load_script("replace_label_with_nearest_valid_label")
+
+
+def synthetic_labels(seed, shape=(9, 8, 7), border=True):
+    """random labels (0 for some of the background), with the unwanted
+    ones only where the mask allows them: inside the volume, away from
+    its border, unless border"""
+    rng = np.random.default_rng(seed)
+    labels = rng.choice(np.array([0, 0, 1, 2, 3], dtype=np.uint16), size=shape)
+    mask = rng.random(shape) < rng.uniform(0.2, 0.8)
+    if not border:
+        mask[[0, -1]] = mask[:, [0, -1]] = mask[:, :, [0, -1]] = False
+    labels[mask] = rng.choice(UNWANTED, size=np.count_nonzero(mask))
+    return labels
+
+
+def loop(rl, labels):
+    # as the script runs --method 26-neighbors-loop
+    outlabels = labels.copy()
+    previous, current = -1, rl.substitute_labels_using_26_nearest_neighbors(labels, outlabels, UNWANTED)
+    while current > 0 and previous != current:
+        previous = current
+        current = rl.substitute_labels_using_26_nearest_neighbors(outlabels.copy(), outlabels, UNWANTED)
+    return outlabels
+
+
+def test_frontier_propagation_matches_the_loop(rl):
+    for seed in range(20):
+        labels = synthetic_labels(seed, border=False)
+        outlabels = labels.copy()
+        rl.substitute_labels_by_frontier_propagation(outlabels, UNWANTED)
+        np.testing.assert_array_equal(outlabels, loop(rl, labels), err_msg="seed %d" % seed)
+
+
+def test_frontier_propagation_replaces_the_border(rl):
+    labels = np.zeros((4, 4, 4), dtype=np.uint16)
+    labels[0, 0, 0] = 7
+    labels[1, 1, 1] = 2
+    labels[3, 3, 3] = 9
+    outlabels = labels.copy()
+    assert rl.substitute_labels_by_frontier_propagation(outlabels, UNWANTED) == 1
+    # the corner next to a valid label is replaced, the other one has none
+    assert outlabels[0, 0, 0] == 2 and outlabels[3, 3, 3] == 9
+
+
+@pytest.mark.parametrize("chunk_slices", [1, 2, 3, 5])
+def test_distance_transform_does_not_depend_on_the_chunks(rl, chunk_slices):
+    separations = (0.3, 1.0, 0.7)
+    for seed in range(10):
+        labels = synthetic_labels(seed, shape=(13, 6, 5))
+        # large unwanted slabs, so that the margins have to grow
+        labels[2:9] = np.where(labels[2:9] == 0, 0, UNWANTED[0])
+        expected, outlabels = labels.copy(), labels.copy()
+        rl.substitute_labels_using_distance_transform(labels, expected, UNWANTED, separations)
+        rl.substitute_labels_using_distance_transform(labels, outlabels, UNWANTED, separations,
+                                                      chunk_slices)
+        np.testing.assert_array_equal(outlabels, expected, err_msg="seed %d" % seed)
@@ -0,0 +1,88 @@
+import subprocess
+
+import numpy as np
+import pytest
+
+from helpers import load_script, requires_tools
+
+
+@pytest.fixture(scope="module")
+def rot():
+    return load_script("rotational_minctracc.py")
+
+
+def read_linear_xfm(filename):
+    with open(filename) as f:
+        text = f.read()
+    values = text.split("Linear_Transform =")[1].split(";")[0].split()
+    return np.array([float(v) for v in values]).reshape(3, 4)
+
+
+def test_rotation_matrix_applies_x_first(rot):
+    composed = rot.rotation_matrix(0, 0, 30).dot(rot.rotation_matrix(0, -40, 0)).dot(
+        rot.rotation_matrix(25, 0, 0))
+    np.testing.assert_allclose(rot.rotation_matrix(25, -40, 30), composed, atol=1e-12)
+    # x then z: the y axis goes to z, which z leaves alone
+    np.testing.assert_allclose(rot.rotation_matrix(90, 0, 90).dot([0, 1, 0]), [0, 0, 1], atol=1e-12)
+
+
+def test_rotation_angles_inverts_rotation_matrix(rot):
+    rng = np.random.default_rng(1)
+    for angles in rng.uniform(-85, 85, size=(20, 3)):
+        np.testing.assert_allclose(rot.rotation_angles(rot.rotation_matrix(*angles)), angles,
+                                   atol=1e-3)
+
+
+def test_rotation_matrix_matches_param2xfm(rot, tmp_path):
+    requires_tools("param2xfm")
+    for angles in [(20, 0, 0), (0, -35, 0), (0, 0, 50), (20, -35, 50), (-60, 45, 10)]:
+        xfm = str(tmp_path / "rotation.xfm")
+        subprocess.check_call(["param2xfm", "-clobber", "-rotations"] + [str(a) for a in angles] + [xfm])
+        np.testing.assert_allclose(rot.rotation_matrix(*angles), read_linear_xfm(xfm)[:, :3],
+                                   atol=1e-6)
+
+
+def test_transform_matrix_matches_param2xfm(rot, tmp_path):
+    requires_tools("param2xfm")
+    xfm = str(tmp_path / "transform.xfm")
+    subprocess.check_call(["param2xfm", "-clobber", "-translation", "1", "-2", "3",
+                           "-rotations", "20", "-35", "50", "-center", "4", "5", "-6", xfm])
+    np.testing.assert_allclose(rot.transform_matrix([1, -2, 3], 20, -35, 50, [4, 5, -6])[:3],
+                               read_linear_xfm(xfm), atol=1e-5)
+
+
+def test_batch_aligns_every_source(rot, tmp_path, monkeypatch):
+    # the registrations themselves (autocrop, minctracc) are replaced; the
+    # rest of the --batch path (target seeds, per-source alignment and
+    # output) is run as is
+    from helpers import write_volume
+    data = np.zeros((12, 12, 12))
+    data[3:9, 4:8, 2:10] = 1
+    target = write_volume(tmp_path / "target.mnc", data)
+    rows = ["source,source_mask,output_xfm,output_mnc"]
+    for i in range(2):
+        source = write_volume(tmp_path / ("source%d.mnc" % i), np.roll(data, i + 1, axis=0))
+        rows.append("%s,,%s,%s" % (source, tmp_path / ("out%d.xfm" % i), tmp_path / ("out%d.mnc" % i)))
+    (tmp_path / "sources.csv").write_text("\n".join(rows) + "\n")
+
+    calls = []
+    def loop_rotations(**kwargs):
+        calls.append(kwargs)
+        transform, resampled = rot.get_tempfile(".xfm"), rot.get_tempfile(".mnc")
+        for f in (transform, resampled):
+            open(f, "w").write(kwargs["source"])
+        return {"transform": transform, "resampled": resampled, "xcorr": 1.0}
+    monkeypatch.setattr(rot, "downsample", lambda infile, stepsize: infile)
+    monkeypatch.setattr(rot, "loop_rotations", loop_rotations)
+    monkeypatch.setattr(rot.signal, "signal", lambda signum, handler: None)
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+
+    rot.main(["--batch", str(tmp_path / "sources.csv"), "--tempdir", str(tmp_path),
+              "--rotation-sampling", "uniform", "--rotation-tolerance", "4", target])
+
+    assert [c["source"] for c in calls] == [str(tmp_path / "source0.mnc"), str(tmp_path / "source1.mnc")]
+    for c in calls:
+        assert c["target_seeds"] is calls[0]["target_seeds"]
+        assert c["rotation_sampling"] == "uniform" and c["rotation_tolerance"] == 4
+    for i in range(2):
+        assert (tmp_path / ("out%d.xfm" % i)).read_text() == str(tmp_path / ("source%d.mnc" % i))
@@ -0,0 +1,23 @@
+import numpy as np
+
+from helpers import read_volume, run_script, write_volume
+
+
+def reference_vote(labels):
+    # the most frequent label at each voxel, the smallest one on ties
+    values = np.unique(labels)
+    counts = np.stack([(labels == v).sum(axis=0) for v in values])
+    return values[counts.argmax(axis=0)], counts.max(axis=0) / labels.shape[0]
+
+
+def test_writes_the_majority_labels(tmp_path):
+    rng = np.random.default_rng(0)
+    labels = rng.choice([0, 3, 7, 250, 1000], size=(5, 13, 6, 7))
+    files = [write_volume(tmp_path / ("labels%d.mnc" % i), l, volumeType="ushort", labels=True)
+             for i, l in enumerate(labels)]
+    run_script("voxel_vote", "--slab-slices", 4, "--confidence", tmp_path / "confidence.mnc",
+               *(files + [tmp_path / "voted.mnc"]))
+
+    winners, confidence = reference_vote(labels)
+    np.testing.assert_array_equal(read_volume(tmp_path / "voted.mnc"), winners)
+    np.testing.assert_allclose(read_volume(tmp_path / "confidence.mnc"), confidence, atol=1e-6)